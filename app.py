@@ -1,16 +1,28 @@
 import os
-import re
 import io
+import base64
 import logging
 import json
 import secrets
+import hashlib
+import functools
+import threading
+import time
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 from flask import Flask, request, render_template, jsonify, make_response
 import google.generativeai as genai
-import PyPDF2
+from google.generativeai import caching
+import fitz  # PyMuPDF
 from docx import Document
+import redis
 from werkzeug.utils import secure_filename
+from flask_compress import Compress
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 
 # -----------------------------
 # Logging
@@ -26,19 +38,59 @@ load_dotenv()
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB
 
+# Gzip JSON responses (ranked results carry a lot of generated text)
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_LEVEL"] = 6
+Compress(app)
+
 API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY:
     raise RuntimeError("❌ GEMINI_API_KEY not found in environment")
 
 genai.configure(api_key=API_KEY)
 
+# -----------------------------
+# Background jobs (optional)
+# -----------------------------
+# Opt-in: with CELERY_BROKER_URL set, /rank queues work for a Celery worker
+# (`celery -A app.celery_app worker`) and returns a job id to poll. Without
+# it (e.g. plain Vercel), /rank runs inline. REDIS_URL alone only enables
+# shared state (usage, rate limits, analysis cache), never the job queue.
+REDIS_URL = os.getenv("REDIS_URL")
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+
+celery_app = None
+if CELERY_BROKER_URL:
+    # Imported here so inline deploys don't pay for it on every cold start
+    from celery import Celery
+
+    # A Redis broker can hold results too; other brokers (e.g. RabbitMQ) have
+    # no matching result backend in Celery 5, so fall back to rpc://
+    result_backend = os.getenv("CELERY_RESULT_BACKEND") or (
+        CELERY_BROKER_URL
+        if CELERY_BROKER_URL.startswith(("redis://", "rediss://"))
+        else "rpc://"
+    )
+    celery_app = Celery("hirerank", broker=CELERY_BROKER_URL, backend=result_backend)
+    celery_app.conf.update(
+        task_acks_late=True,  # don't lose a job if a worker dies mid-analysis
+        worker_prefetch_multiplier=1,  # fair dispatch for long, uneven tasks
+        result_expires=3600,
+    )
+
 # -----------------------------
 # SaaS usage tracking (demo)
 # -----------------------------
-# NOTE: This in-memory counter resets when the Vercel function is reloaded.
-# For production, persist this in a DB keyed by user ID or auth token.
+# Usage is stored in Redis when REDIS_URL is set, so it survives restarts and
+# is shared across workers. Otherwise it falls back to an in-memory counter,
+# which resets when the Vercel function is reloaded.
 FREE_LIMIT = 10  # total resumes allowed per token in free tier
-USAGE_COUNTER = {}  # token -> int (resumes analyzed)
+USAGE_TTL_SECONDS = 30 * 86400  # forget idle tokens after 30 days
+
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+USAGE_COUNTER = {}  # token -> int (resumes analyzed), no-Redis fallback
+USAGE_LOCK = threading.Lock()
 
 def get_client_token():
     """
@@ -50,38 +102,124 @@ def get_client_token():
         token = secrets.token_hex(16)
     return token
 
+def _usage_key(token: str) -> str:
+    return f"usage:{token}"
+
 def get_used_count(token: str) -> int:
+    if redis_client is not None:
+        return int(redis_client.get(_usage_key(token)) or 0)
     return int(USAGE_COUNTER.get(token, 0))
 
-def increment_usage(token: str, count: int) -> None:
-    current = get_used_count(token)
-    USAGE_COUNTER[token] = current + count
+def increment_usage(token: str, count: int) -> int:
+    """Atomically add `count` (may be negative) and return the new total."""
+    if redis_client is not None:
+        pipe = redis_client.pipeline()
+        pipe.incrby(_usage_key(token), count)
+        pipe.expire(_usage_key(token), USAGE_TTL_SECONDS)
+        total, _ = pipe.execute()
+        return int(total)
+    with USAGE_LOCK:
+        total = int(USAGE_COUNTER.get(token, 0)) + count
+        USAGE_COUNTER[token] = total
+        return total
+
+def reserve_usage(token: str, count: int):
+    """
+    Claim `count` resumes of the free quota in one atomic step.
+    Returns (ok, used): on success `used` includes the reservation; if it
+    would exceed FREE_LIMIT nothing is charged and `used` is the prior total.
+    """
+    total = increment_usage(token, count)
+    if total > FREE_LIMIT:
+        return False, increment_usage(token, -count)
+    return True, total
+
+# -----------------------------
+# Rate limiting
+# -----------------------------
+# Throttles request frequency per client so one user can't burst through
+# shared Gemini throughput. Counters share the usage Redis when available.
+def rate_limit_key() -> str:
+    # Cookie-less requests would get a fresh random token each time,
+    # so fall back to the client address for those.
+    return request.cookies.get("hr_token") or get_remote_address()
+
+limiter = Limiter(
+    key_func=rate_limit_key,
+    app=app,
+    default_limits=["30/minute", "5/second"],
+    storage_uri=REDIS_URL or "memory://",
+)
+
+@app.errorhandler(429)
+def rate_limited(e):
+    return (
+        jsonify(
+            {
+                "success": False,
+                "error": f"Too many requests ({e.description}). Please wait and try again.",
+            }
+        ),
+        429,
+    )
 
 # -----------------------------
 # 🔥 Auto-detect usable model
 # -----------------------------
+MODEL_CACHE_PATH = "/tmp/.model_cache"
+MODEL_CACHE_MAX_AGE = 24 * 3600  # re-discover daily in case a model is retired
+
+def _read_model_cache(key_hash: str):
+    try:
+        if time.time() - os.path.getmtime(MODEL_CACHE_PATH) > MODEL_CACHE_MAX_AGE:
+            return None
+        with open(MODEL_CACHE_PATH) as f:
+            return json.load(f).get(key_hash)
+    except (OSError, ValueError):
+        return None
+
+def _write_model_cache(key_hash: str, name: str) -> None:
+    try:
+        with open(MODEL_CACHE_PATH, "w") as f:
+            json.dump({key_hash: name}, f)
+    except OSError as e:
+        logger.warning(f"Could not write model cache: {e}")
+
+@functools.lru_cache(maxsize=1)
 def get_available_model():
     """
     Find a Gemini model that supports generateContent.
     Prefer newer flash models, but fall back safely.
+    GEMINI_MODEL pins the model and skips discovery entirely; otherwise the
+    result is cached in /tmp per API key for a day, so warm starts skip
+    list_models().
     """
+    pinned = os.getenv("GEMINI_MODEL")
+    if pinned:
+        return pinned if pinned.startswith("models/") else f"models/{pinned}"
+
+    key_hash = hashlib.sha256(API_KEY.encode()).hexdigest()
+    cached = _read_model_cache(key_hash)
+    if cached:
+        return cached
+
     try:
-        models = genai.list_models()
+        usable = [
+            m.name
+            for m in genai.list_models()
+            if "generateContent" in getattr(m, "supported_generation_methods", [])
+        ]
+        usable_set = set(usable)
         preferred_names = ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-flash"]
 
-        # Prefer specific flash models if available
-        for name in preferred_names:
-            for m in models:
-                if (
-                    m.name == f"models/{name}"
-                    and "generateContent" in getattr(m, "supported_generation_methods", [])
-                ):
-                    return m.name
-
-        # Fallback: any model that supports generateContent
-        for m in models:
-            if "generateContent" in getattr(m, "supported_generation_methods", []):
-                return m.name
+        # Prefer specific flash models if available, else anything usable
+        name = next(
+            (f"models/{n}" for n in preferred_names if f"models/{n}" in usable_set),
+            usable[0] if usable else None,
+        )
+        if name:
+            _write_model_cache(key_hash, name)
+            return name
     except Exception as e:
         logger.warning(f"Could not list models, using default: {e}")
 
@@ -97,30 +235,139 @@ print("🔍 Using model:", MODEL_NAME)
 # -----------------------------
 ALLOWED_EXTENSIONS = {"pdf", "docx", "txt"}
 
-def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+# Only this much resume text is sent to Gemini, so extractors stop once
+# they have collected it instead of parsing the rest of the document.
+MAX_RESUME_CHARS = 4000
 
-def extract_text_from_pdf(file_storage) -> str:
-    """Extract text from PDF."""
+def _ext(filename: str) -> str:
+    """Lower-case extension without the dot ("" if none)."""
+    return os.path.splitext(filename)[1][1:].lower()
+
+def _upload_stream(file_storage):
+    """
+    Underlying file object of an upload, rewound. Werkzeug already spools
+    large uploads to a temp file, so parsers read from that directly
+    instead of copying the whole upload into a bytes object first.
+    """
+    stream = getattr(file_storage, "stream", file_storage)
+    stream.seek(0)
+    return stream
+
+GUTTER_MIN_WIDTH = 10  # pt of empty space that separates two columns
+MIN_COLUMN_SHARE = 0.2  # each column must cover this much of the text width
+
+def _find_gutter(blocks):
+    """
+    x position of a vertical gap between columns, or None. Blocks may only
+    cross the gap entirely (full-width headers/paragraphs), never start or
+    end inside it. Prefers the gap crossed by the fewest blocks.
+    """
+    best = None
+    for a in {b[2] for b in blocks}:
+        c = a + GUTTER_MIN_WIDTH
+        left = right = spanning = 0
+        for x0, _, x1, *_ in blocks:
+            if x1 <= a:
+                left += 1
+            elif x0 >= c:
+                right += 1
+            elif x0 < a and x1 > c:
+                spanning += 1
+            else:
+                break  # block edge inside the gap
+        else:
+            if left and right and (best is None or spanning < best[0]):
+                best = (spanning, a)
+    return None if best is None else best[1] + GUTTER_MIN_WIDTH / 2
+
+def _reading_order(blocks) -> list:
+    """
+    Order (x0, y0, x1, y1, text, ...) blocks for reading. Without a gutter
+    this is plain top-to-bottom order. With one, blocks crossing the gutter
+    (full-width header or paragraph bands) stay in y-order and split the
+    page into segments; inside a segment the left column is read before the
+    right one, if both are wide enough to be real columns rather than e.g.
+    right-aligned dates or contact details.
+    """
+    by_y = sorted(blocks, key=lambda b: (b[1], b[0]))
+    gutter = _find_gutter(blocks)
+    if gutter is None:
+        return by_y
+
+    min_width = MIN_COLUMN_SHARE * (
+        max(b[2] for b in blocks) - min(b[0] for b in blocks)
+    )
+
+    def extent(column):
+        return max(b[2] for b in column) - min(b[0] for b in column)
+
+    ordered, segment = [], []
+
+    def flush():
+        left = [b for b in segment if b[2] <= gutter]
+        right = [b for b in segment if b[0] >= gutter]
+        if left and right and min(extent(left), extent(right)) >= min_width:
+            ordered.extend(left + right)
+        else:
+            ordered.extend(segment)
+        segment.clear()
+
+    for b in by_y:
+        if b[0] < gutter < b[2]:
+            flush()
+            ordered.append(b)
+        else:
+            segment.append(b)
+    flush()
+    return ordered
+
+def _page_text_in_reading_order(page) -> str:
+    """Join a PDF page's text blocks in reading order (see _reading_order)."""
+    blocks = [b for b in page.get_text("blocks") if b[6] == 0]  # skip images
+    return "\n".join(b[4].strip() for b in _reading_order(blocks))
+
+def read_pdf(file_storage):
+    """
+    Extract text from PDF. Returns (text, page_count, data); page_count is 0
+    when the file could not be opened as a PDF, which tells a broken upload
+    apart from a readable PDF that simply has no text layer. `data` is the
+    PDF's bytes, read once here so the scanned-PDF check can reuse them.
+    """
+    data = b""
     try:
-        bytes_data = file_storage.read()
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(bytes_data))
-        text = ""
-        for page in pdf_reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-        return text.strip()
+        data = _upload_stream(file_storage).read()
+        doc = fitz.open(stream=data, filetype="pdf")
+        parts, size = [], 0
+        try:
+            page_count = doc.page_count
+            for page in doc:
+                page_text = _page_text_in_reading_order(page)
+                parts.append(page_text)
+                size += len(page_text)
+                if size >= MAX_RESUME_CHARS:
+                    break
+        finally:
+            doc.close()
+        return "\n".join(parts).strip(), page_count, data
     except Exception as e:
         logger.error(f"PDF extraction error: {e}")
-        return ""
+        return "", 0, data
+
+def extract_text_from_pdf(file_storage) -> str:
+    """Extract text from PDF."""
+    return read_pdf(file_storage)[0]
 
 def extract_text_from_docx(file_storage) -> str:
     """Extract text from DOCX."""
     try:
-        bytes_data = file_storage.read()
-        doc = Document(io.BytesIO(bytes_data))
-        lines = [p.text for p in doc.paragraphs if p.text.strip()]
+        doc = Document(_upload_stream(file_storage))
+        lines, size = [], 0
+        for p in doc.paragraphs:
+            if p.text.strip():
+                lines.append(p.text)
+                size += len(p.text)
+                if size >= MAX_RESUME_CHARS:
+                    break
         return "\n".join(lines).strip()
     except Exception as e:
         logger.error(f"DOCX extraction error: {e}")
@@ -129,119 +376,578 @@ def extract_text_from_docx(file_storage) -> str:
 def extract_text_from_txt(file_storage) -> str:
     """Extract text from TXT."""
     try:
-        bytes_data = file_storage.read()
+        # UTF-8 is at most 4 bytes per char, so this always covers the cap
+        bytes_data = _upload_stream(file_storage).read(MAX_RESUME_CHARS * 4)
         return bytes_data.decode("utf-8", errors="ignore").strip()
     except Exception as e:
         logger.error(f"TXT extraction error: {e}")
         return ""
 
-def parse_resume(filename: str, file_storage) -> str:
-    """Dispatch to correct parser based on extension."""
-    ext = filename.rsplit(".", 1)[1].lower()
-    if ext == "pdf":
-        return extract_text_from_pdf(file_storage)
-    if ext == "docx":
-        return extract_text_from_docx(file_storage)
-    if ext == "txt":
-        return extract_text_from_txt(file_storage)
-    return ""
+EXTRACTORS = {
+    "pdf": extract_text_from_pdf,
+    "docx": extract_text_from_docx,
+    "txt": extract_text_from_txt,
+}
+
+def parse_resume(ext: str, file_storage) -> str:
+    """Dispatch to correct parser based on extension (see _ext)."""
+    extractor = EXTRACTORS.get(ext)
+    return extractor(file_storage) if extractor else ""
+
+# Extracted characters per KB of PDF below which the text layer is treated as
+# missing (scanned resume). Those PDFs go to Gemini as documents instead;
+# everything else stays on the much cheaper text-only path.
+SCANNED_TEXTNESS = 5
+MAX_INLINE_PDF_BYTES = 15 * 1024 * 1024  # inline request data is capped at 20MB
+
+def scanned_pdf_bytes(filename: str, data: bytes, resume_text: str):
+    """
+    Return `data` (the bytes of a PDF that opened fine) if its extracted
+    text looks unusable, else None.
+    """
+    if len(resume_text) >= MAX_RESUME_CHARS:
+        return None  # extraction stopped early, plenty of text
+
+    size = len(data)
+    textness = len(resume_text) / max(1, size / 1024)
+    if textness >= SCANNED_TEXTNESS or size > MAX_INLINE_PDF_BYTES:
+        logger.info(f"{filename}: text path (textness {textness:.1f})")
+        return None
+
+    logger.info(f"{filename}: scanned PDF path (textness {textness:.1f})")
+    return data
+
+# -----------------------------
+# Analysis cache
+# -----------------------------
+# Re-running the same job description against the same resume returns the
+# stored analysis instead of calling Gemini again. Entries live in Redis when
+# available (shared across workers), else in a per-process LRU.
+ANALYSIS_CACHE_SIZE = 1024
+ANALYSIS_CACHE_TTL_SECONDS = 24 * 3600
+
+ANALYSIS_CACHE = OrderedDict()  # key -> JSON string, no-Redis fallback
+ANALYSIS_CACHE_LOCK = threading.Lock()
+
+def analysis_cache_key(job_desc: str, resume_text: str) -> str:
+    # Only the truncated text reaches the model, so only it affects the result
+    data = job_desc + "\x00" + resume_text[:MAX_RESUME_CHARS]
+    digest = hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+    return f"analysis:{digest}"
+
+def get_cached_analysis(job_desc: str, resume_text: str):
+    key = analysis_cache_key(job_desc, resume_text)
+    try:
+        if redis_client is not None:
+            raw = redis_client.get(key)
+        else:
+            with ANALYSIS_CACHE_LOCK:
+                raw = ANALYSIS_CACHE.get(key)
+                if raw is not None:
+                    ANALYSIS_CACHE.move_to_end(key)
+    except Exception as e:
+        logger.warning(f"Analysis cache read failed: {e}")
+        return None
+    # Stored as JSON so every hit is a fresh dict callers can modify
+    return json.loads(raw) if raw else None
+
+def set_cached_analysis(job_desc: str, resume_text: str, result: dict) -> None:
+    key = analysis_cache_key(job_desc, resume_text)
+    raw = json.dumps(result)
+    try:
+        if redis_client is not None:
+            redis_client.setex(key, ANALYSIS_CACHE_TTL_SECONDS, raw)
+        else:
+            with ANALYSIS_CACHE_LOCK:
+                ANALYSIS_CACHE[key] = raw
+                ANALYSIS_CACHE.move_to_end(key)
+                while len(ANALYSIS_CACHE) > ANALYSIS_CACHE_SIZE:
+                    ANALYSIS_CACHE.popitem(last=False)
+    except Exception as e:
+        logger.warning(f"Analysis cache write failed: {e}")
 
 # -----------------------------
 # Gemini analysis for resumes
 # -----------------------------
-def analyze_resume_with_gemini(job_desc: str, resume_text: str, filename: str) -> dict:
+HR_ANALYST_INSTRUCTIONS = """
+You are an expert HR AI analyst.
+
+Score each resume against the job description. Every score is an integer
+from 0 to 100: overallScore plus the breakdown metrics skillsMatch,
+experience, education, atsScore and careerFit. List concrete strengths and
+gaps, and give a short hiring recommendation.
+
+Use the real match quality to choose scores. Be strict but fair.
+"""
+
+# Weighted overall score, computed locally from the model's breakdown
+BREAKDOWN_WEIGHTS = {
+    "skillsMatch": 0.30,
+    "experience": 0.25,
+    "education": 0.15,
+    "atsScore": 0.20,
+    "careerFit": 0.10,
+}
+BREAKDOWN_KEYS = tuple(BREAKDOWN_WEIGHTS)
+
+_SCORE = {"type": "integer"}
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "overallScore": _SCORE,
+        "breakdown": {
+            "type": "object",
+            "properties": {
+                "skillsMatch": _SCORE,
+                "experience": _SCORE,
+                "education": _SCORE,
+                "atsScore": _SCORE,
+                "careerFit": _SCORE,
+            },
+            "required": [
+                "skillsMatch",
+                "experience",
+                "education",
+                "atsScore",
+                "careerFit",
+            ],
+        },
+        "strengths": _STRING_LIST,
+        "gaps": _STRING_LIST,
+        "recommendation": {"type": "string"},
+    },
+    "required": ["overallScore", "breakdown", "strengths", "gaps", "recommendation"],
+}
+
+# Structured output: Gemini returns JSON matching ANALYSIS_SCHEMA
+ANALYSIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ANALYSIS_SCHEMA,
+}
+
+BATCH_SIZE = 5  # resumes analyzed per Gemini call
+
+# Batch items carry the resume's number so results are matched by it, not
+# by position
+BATCH_ITEM_SCHEMA = {
+    **ANALYSIS_SCHEMA,
+    "properties": {"index": {"type": "integer"}, **ANALYSIS_SCHEMA["properties"]},
+    "required": ["index", *ANALYSIS_SCHEMA["required"]],
+}
+
+BATCH_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {"results": {"type": "array", "items": BATCH_ITEM_SCHEMA}},
+        "required": ["results"],
+    },
+}
+
+JOB_CACHE_TTL = datetime.timedelta(minutes=10)  # SDK rejects "600s" strings
+JOB_CACHE_MIN_TOKENS = 1024  # smallest explicit cache Gemini accepts (2.5 Flash)
+CHARS_PER_TOKEN = 4  # rough estimate for English text
+# One call can't reuse anything; from the second call on the prefix is billed
+# at the cached rate. With FREE_LIMIT=10 and BATCH_SIZE=5 a request makes at
+# most 2 batch calls, so this is the only threshold the free tier can reach.
+JOB_CACHE_MIN_CALLS = 2
+
+def job_cache_worthwhile(job_desc: str, expected_calls: int) -> bool:
+    """Whether an explicit cache can be created and will pay for itself."""
+    return (
+        expected_calls >= JOB_CACHE_MIN_CALLS
+        and len(prompt_prefix(job_desc)) >= JOB_CACHE_MIN_TOKENS * CHARS_PER_TOKEN
+    )
+
+def create_job_cache(job_desc: str):
     """
-    Advanced multi-metric analysis.
-    Returns a dict matching your frontend expectations.
+    Cache the instructions + job description once per /rank request so each
+    resume call only sends its own content. Returns None if creation fails;
+    check job_cache_worthwhile first to skip the round trip.
     """
-    prompt = f"""
-You are an expert HR AI analyst.
+    try:
+        return caching.CachedContent.create(
+            model=MODEL_NAME,
+            system_instruction=HR_ANALYST_INSTRUCTIONS,
+            contents=[f"JOB DESCRIPTION:\n{job_desc}"],
+            ttl=JOB_CACHE_TTL,
+        )
+    except Exception as e:
+        # Size/call-count gating happens before this, so failures are real
+        logger.warning(f"Context cache creation failed, sending full prompt: {e}")
+        return None
+
+def delete_job_cache(cache) -> None:
+    if cache is None:
+        return
+    try:
+        cache.delete()
+    except Exception as e:
+        logger.warning(f"Could not delete context cache: {e}")
 
-Return output as VALID JSON ONLY.
-No explanations, no markdown, no backticks.
+def _extract_json_block(content: str):
+    """
+    Return the first balanced {...} object in `content`, or None.
+    Single linear scan (string-aware), so it can't backtrack on long output.
+    """
+    start = content.find("{")
+    if start == -1:
+        return None
+    depth, in_string, escaped = 0, False, False
+    for i in range(start, len(content)):
+        ch = content[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return content[start : i + 1]
+    return None
 
-JOB DESCRIPTION:
-{job_desc}
+def _load_json(content: str) -> dict:
+    """
+    Parse a structured-output response. Normally the whole body is JSON; the
+    block scan only runs if the model wrapped it in extra text anyway.
+    """
+    try:
+        return json.loads(content)
+    except ValueError:
+        block = _extract_json_block(content)
+        if block is None:
+            raise ValueError("No JSON found in Gemini response")
+        return json.loads(block)
 
-RESUME:
-Filename: {filename}
-Content: {resume_text[:4000]}...
-
-Output JSON must match exactly:
-
-{{
-  "overallScore": 0-100,
-  "breakdown": {{
-    "skillsMatch": 0-100,
-    "experience": 0-100,
-    "education": 0-100,
-    "atsScore": 0-100,
-    "careerFit": 0-100
-  }},
-  "strengths": ["..."],
-  "gaps": ["..."],
-  "recommendation": "..."
-}}
+def prompt_prefix(job_desc: str) -> str:
+    """
+    Instructions + job description. Keeping this prefix byte-identical (and
+    first) across every resume call lets Gemini's implicit prompt caching
+    reuse it. Deliberately not memoized: the job description is user input
+    and only bounded by MAX_CONTENT_LENGTH.
+    """
+    return "".join((HR_ANALYST_INSTRUCTIONS, "\nJOB DESCRIPTION:\n", job_desc, "\n"))
 
-Use the real match quality to choose scores. Be strict but fair.
-"""
+def _model_and_prompt(job_desc: str, resume_prompt: str, cache):
+    """Pick the cached-context model if available, else send the full prompt."""
+    if cache is not None:
+        return genai.GenerativeModel.from_cached_content(cached_content=cache), resume_prompt
+    return model, prompt_prefix(job_desc) + resume_prompt
+
+def normalize_analysis(result: dict) -> dict:
+    """Clamp scores, recompute the weighted overall and coerce field types."""
+    raw = result.get("breakdown") or {}
+    breakdown = {
+        k: max(0, min(100, int(raw.get(k, 0)))) for k in BREAKDOWN_KEYS
+    }
+    result["breakdown"] = breakdown
+
+    # Weights sum to 1, so the clamped breakdown keeps this within 0-100
+    result["overallScore"] = round(
+        sum(breakdown[k] * w for k, w in BREAKDOWN_WEIGHTS.items())
+    )
+
+    # Normalize other fields
+    result["strengths"] = list(result.get("strengths", []))
+    result["gaps"] = list(result.get("gaps", []))
+    result["recommendation"] = str(
+        result.get("recommendation", "Review Manually")
+    )
+
+    return result
+
+def fallback_result(filename: str) -> dict:
+    """Neutral scores so the UI still works when analysis fails."""
+    return {
+        "filename": filename,
+        "overallScore": 50,
+        "breakdown": {
+            "skillsMatch": 50,
+            "experience": 50,
+            "education": 50,
+            "atsScore": 50,
+            "careerFit": 50,
+        },
+        "strengths": ["Analysis unavailable"],
+        "gaps": ["Please check resume format or try again later"],
+        "recommendation": "Review Manually",
+    }
+
+def _response_text(response, label: str):
+    """
+    Stripped text of a Gemini response, or None if it was blocked or can't
+    contain JSON. Checked up front so these cases skip the parse/except path.
+    """
+    feedback = getattr(response, "prompt_feedback", None)
+    block_reason = getattr(feedback, "block_reason", None)
+    if block_reason:
+        logger.warning(f"Gemini blocked the prompt for {label}: {block_reason}")
+        return None
     try:
-        response = model.generate_content(prompt)
         content = (response.text or "").strip()
-        logger.info(f"Gemini raw for {filename}: {content[:200]}")
+    except ValueError as e:
+        # .text raises when no candidate has text (e.g. safety-stopped)
+        logger.warning(f"Gemini returned no text for {label}: {e}")
+        return None
+    if "{" not in content:
+        logger.warning(f"Gemini returned no JSON for {label}: {content[:200]!r}")
+        return None
+    return content
 
-        # Try direct JSON first
-        try:
-            result = json.loads(content)
-        except Exception:
-            # Fallback: largest { ... } block
-            json_match = re.search(r"\{[\s\S]*\}", content)
-            if not json_match:
-                raise ValueError("No JSON found in Gemini response")
-            result = json.loads(json_match.group())
-
-        # Ensure breakdown present
-        result.setdefault("breakdown", {})
-        for key in ["skillsMatch", "experience", "education", "atsScore", "careerFit"]:
-            val = int(result["breakdown"].get(key, 0))
-            result["breakdown"][key] = max(0, min(100, val))
-
-        # Weighted overall
-        weights = {
-            "skillsMatch": 0.30,
-            "experience": 0.25,
-            "education": 0.15,
-            "atsScore": 0.20,
-            "careerFit": 0.10,
-        }
-        calculated_score = sum(result["breakdown"][k] * w for k, w in weights.items())
-        result["overallScore"] = round(max(0, min(100, calculated_score)))
-
-        # Normalize other fields
-        result["strengths"] = list(result.get("strengths", []))
-        result["gaps"] = list(result.get("gaps", []))
-        result["recommendation"] = str(
-            result.get("recommendation", "Review Manually")
+def analyze_resume_with_gemini(
+    job_desc: str, resume_text: str, filename: str, cache=None, pdf_bytes=None
+) -> dict:
+    """
+    Advanced multi-metric analysis.
+    Returns a dict matching your frontend expectations.
+    If `cache` is given, the instructions and job description are read from it.
+    `pdf_bytes` attaches the original PDF for scanned resumes without text.
+    """
+    if pdf_bytes is None:
+        content_line = f"Content: {resume_text[:MAX_RESUME_CHARS]}..."
+    else:
+        content_line = "Content: see the attached PDF (scanned resume)."
+    active_model, prompt = _model_and_prompt(
+        job_desc,
+        f"""
+RESUME:
+Filename: {filename}
+{content_line}
+""",
+        cache,
+    )
+    if pdf_bytes is not None:
+        prompt = [prompt, {"mime_type": "application/pdf", "data": pdf_bytes}]
+    try:
+        response = active_model.generate_content(
+            prompt, generation_config=ANALYSIS_CONFIG
         )
+        content = _response_text(response, filename)
+        if content is None:
+            return fallback_result(filename)
+        logger.info(f"Gemini raw for {filename}: {content[:200]}")
 
+        result = normalize_analysis(_load_json(content))
+        if pdf_bytes is None:
+            set_cached_analysis(job_desc, resume_text, result)
         return result
 
     except Exception as e:
         logger.error(f"Gemini analysis error for {filename}: {e}")
-        # Fallback neutral scores so UI still works
-        return {
-            "overallScore": 50,
-            "breakdown": {
-                "skillsMatch": 50,
-                "experience": 50,
-                "education": 50,
-                "atsScore": 50,
-                "careerFit": 50,
-            },
-            "strengths": ["Analysis unavailable"],
-            "gaps": ["Please check resume format or try again later"],
-            "recommendation": "Review Manually",
-        }
+        return fallback_result(filename)
+
+def analyze_resumes_batch(job_desc: str, resumes: list, cache=None) -> list:
+    """
+    Analyze several (filename, resume_text) pairs in a single Gemini call.
+    Returns one analysis dict per resume, in input order. Falls back to
+    per-resume calls if the batch response can't be used.
+    """
+    if len(resumes) == 1:
+        filename, resume_text = resumes[0]
+        return [analyze_resume_with_gemini(job_desc, resume_text, filename, cache)]
+
+    blocks = "".join(
+        f"""
+RESUME {i}:
+Filename: {filename}
+Content: {resume_text[:MAX_RESUME_CHARS]}...
+"""
+        for i, (filename, resume_text) in enumerate(resumes, start=1)
+    )
+    active_model, prompt = _model_and_prompt(
+        job_desc,
+        f"""{blocks}
+Return exactly {len(resumes)} results in "results", one per resume.
+Set "index" to the number of the RESUME block each result is for.
+""",
+        cache,
+    )
+    names = ", ".join(filename for filename, _ in resumes)
+
+    def one_by_one():
+        return [
+            analyze_resume_with_gemini(job_desc, resume_text, filename, cache)
+            for filename, resume_text in resumes
+        ]
+
+    try:
+        response = active_model.generate_content(
+            prompt, generation_config=BATCH_CONFIG
+        )
+        content = _response_text(response, f"batch [{names}]")
+        if content is None:
+            # One resume may have tripped the filter; isolate it
+            return one_by_one()
+        logger.info(f"Gemini raw for batch [{names}]: {content[:200]}")
+
+        raw = _load_json(content)["results"]
+        by_index = {int(result.pop("index", 0)): result for result in raw}
+        expected = set(range(1, len(resumes) + 1))
+        # Exactly one result per resume number, or nothing is trusted
+        if len(raw) != len(resumes) or set(by_index) != expected:
+            raise ValueError(
+                f"expected indices 1-{len(resumes)}, "
+                f"got {sorted(by_index)} from {len(raw)} results"
+            )
+        results = [
+            normalize_analysis(by_index[i]) for i in range(1, len(resumes) + 1)
+        ]
+        for (_, resume_text), result in zip(resumes, results):
+            set_cached_analysis(job_desc, resume_text, result)
+        return results
+
+    except Exception as e:
+        logger.warning(f"Batch analysis failed for [{names}], retrying one by one: {e}")
+        return one_by_one()
+
+# -----------------------------
+# Ranking pipeline
+# -----------------------------
+def parse_failed_result(filename: str) -> dict:
+    return {
+        "filename": filename,
+        "overallScore": 0,
+        "breakdown": {
+            "skillsMatch": 0,
+            "experience": 0,
+            "education": 0,
+            "atsScore": 0,
+            "careerFit": 0,
+        },
+        "strengths": [],
+        "gaps": ["Could not parse resume content"],
+        "recommendation": "Parsing Failed - Check Format",
+    }
+
+PARSE_WORKERS = min((os.cpu_count() or 1) * 2, 8)
+GEMINI_WORKERS = 10
+
+def _parse_upload(filename: str, ext: str, file_storage):
+    """Extract (resume_text, scanned_pdf_bytes_or_None) from one upload."""
+    logger.info(f"Processing {filename}")
+    if ext != "pdf":
+        return parse_resume(ext, file_storage), None
+
+    resume_text, page_count, data = read_pdf(file_storage)
+    if not page_count:
+        return resume_text, None  # unreadable PDF: report a parse failure
+    return resume_text, scanned_pdf_bytes(filename, data, resume_text)
+
+def rank_uploaded_resumes(job_desc: str, uploads: list) -> list:
+    """
+    Parse (filename, ext, file-like) uploads and rank them against the job
+    description. Files are parsed on a thread pool, and each batch of
+    BATCH_SIZE resumes goes to Gemini as soon as it fills, so extraction of
+    later files overlaps model calls for earlier ones. Cached analyses are
+    reused and scanned PDFs are analyzed one by one from the PDF itself.
+    Results keep the input order.
+    """
+    results = [parse_failed_result(filename) for filename, _, _ in uploads]
+    gemini_jobs = []  # (upload indices, future -> one analysis per index)
+    pending = []  # (index, resume_text) waiting to fill a batch
+    cache_future = None
+
+    def analyze_scanned(filename, resume_text, pdf_bytes, cache):
+        return [
+            analyze_resume_with_gemini(
+                job_desc, resume_text, filename, cache, pdf_bytes=pdf_bytes
+            )
+        ]
+
+    try:
+        with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as parse_pool, \
+                ThreadPoolExecutor(max_workers=GEMINI_WORKERS) as gemini_pool:
+
+            # Estimated before parsing, so cache creation then runs on
+            # the Gemini pool instead of stalling the parse loop below
+            expected_calls = -(-len(uploads) // BATCH_SIZE)
+            if job_cache_worthwhile(job_desc, expected_calls):
+                cache_future = gemini_pool.submit(create_job_cache, job_desc)
+
+            def cache():
+                return cache_future.result() if cache_future else None
+
+            def dispatch(indices, fn, *args):
+                gemini_jobs.append(
+                    (indices, gemini_pool.submit(lambda: fn(*args, cache())))
+                )
+
+            def dispatch_pending():
+                dispatch(
+                    [i for i, _ in pending],
+                    analyze_resumes_batch,
+                    job_desc,
+                    [(uploads[i][0], text) for i, text in pending],
+                )
+                pending.clear()
+
+            # Each worker only touches its own upload's stream
+            parse_futures = {
+                parse_pool.submit(_parse_upload, filename, ext, file): i
+                for i, (filename, ext, file) in enumerate(uploads)
+            }
+            for future in as_completed(parse_futures):
+                i = parse_futures[future]
+                filename = uploads[i][0]
+                resume_text, pdf_bytes = future.result()
+
+                if pdf_bytes is not None:
+                    dispatch([i], analyze_scanned, filename, resume_text, pdf_bytes)
+                    continue
+                if not resume_text:
+                    continue
+
+                cached = get_cached_analysis(job_desc, resume_text)
+                if cached is not None:
+                    logger.info(f"Cache hit for {filename}")
+                    cached["filename"] = filename
+                    results[i] = cached
+                    continue
+
+                pending.append((i, resume_text))
+                if len(pending) == BATCH_SIZE:
+                    dispatch_pending()
+            if pending:
+                dispatch_pending()
+
+            for indices, future in gemini_jobs:
+                for i, analysis in zip(indices, future.result()):
+                    analysis["filename"] = uploads[i][0]
+                    results[i] = analysis
+    finally:
+        if cache_future is not None:
+            delete_job_cache(cache_future.result())
+
+    return results
+
+if celery_app is not None:
+
+    @celery_app.task(name="hirerank.rank")
+    def rank_task(job_desc: str, resume_blobs: list, token: str) -> list:
+        """
+        Worker side of /rank. `resume_blobs` is [(filename, ext, base64 bytes)].
+        """
+        logger.info(f"Token {token}: ranking {len(resume_blobs)} resumes in worker")
+        uploads = [
+            (filename, ext, io.BytesIO(base64.b64decode(blob)))
+            for filename, ext, blob in resume_blobs
+        ]
+        try:
+            return rank_uploaded_resumes(job_desc, uploads)
+        except Exception:
+            # Same as the inline path: nothing was analyzed, refund the quota
+            # that /rank reserved when it queued this job
+            increment_usage(token, -len(resume_blobs))
+            raise
 
 # -----------------------------
 # Routes
@@ -280,9 +986,11 @@ def list_models():
         return jsonify({"error": str(e)}), 500
 
 @app.route("/rank", methods=["POST"])
+@limiter.limit("3/minute")
 def rank_resumes():
+    token = get_client_token()
+    reserved = False
     try:
-        token = get_client_token()
         used = get_used_count(token)
 
         # Free tier hard limit check
@@ -318,10 +1026,16 @@ def rank_resumes():
                 400,
             )
 
-        valid_files = [
-            f for f in files if f and f.filename and allowed_file(f.filename)
-        ]
-        if not valid_files:
+        uploads = []  # (filename, ext, FileStorage)
+        for f in files:
+            if not (f and f.filename):
+                continue
+            # Taken from the raw name: secure_filename drops non-ASCII
+            # names entirely, e.g. "简历.pdf" becomes "pdf"
+            ext = _ext(f.filename)
+            if ext in ALLOWED_EXTENSIONS:
+                uploads.append((secure_filename(f.filename), ext, f))
+        if not uploads:
             return (
                 jsonify(
                     {
@@ -332,15 +1046,16 @@ def rank_resumes():
                 400,
             )
 
-        # Enforce per-request not to exceed remaining quota
-        remaining = max(0, FREE_LIMIT - used)
-        if len(valid_files) > remaining:
+        # Charge the quota up front so concurrent requests can't overspend it
+        reserved, used_after = reserve_usage(token, len(uploads))
+        if not reserved:
+            remaining = max(0, FREE_LIMIT - used_after)
             return (
                 jsonify(
                     {
                         "success": False,
                         "error": f"Free tier remaining: {remaining} resume(s). Reduce selection or upgrade.",
-                        "used": used,
+                        "used": used_after,
                         "limit": FREE_LIMIT,
                         "remaining": remaining,
                     }
@@ -348,39 +1063,31 @@ def rank_resumes():
                 402,
             )
 
-        results = []
-        for file in valid_files:
-            filename = secure_filename(file.filename)
-            logger.info(f"Processing {filename}")
-
-            file.seek(0)
-            resume_text = parse_resume(filename, file)
-
-            if resume_text:
-                analysis = analyze_resume_with_gemini(job_desc, resume_text, filename)
-                analysis["filename"] = filename
-                results.append(analysis)
-            else:
-                results.append(
-                    {
-                        "filename": filename,
-                        "overallScore": 0,
-                        "breakdown": {
-                            "skillsMatch": 0,
-                            "experience": 0,
-                            "education": 0,
-                            "atsScore": 0,
-                            "careerFit": 0,
-                        },
-                        "strengths": [],
-                        "gaps": ["Could not parse resume content"],
-                        "recommendation": "Parsing Failed - Check Format",
-                    }
+        if celery_app is not None:
+            resume_blobs = []
+            for filename, ext, file in uploads:
+                file.seek(0)
+                resume_blobs.append(
+                    (filename, ext, base64.b64encode(file.read()).decode("ascii"))
                 )
+            task = rank_task.delay(job_desc, resume_blobs, token)
+            logger.info(f"Token {token}: queued job {task.id} ({used_after}/{FREE_LIMIT})")
 
-        # Update usage counter (increment by number of resumes just processed)
-        increment_usage(token, len(valid_files))
-        used_after = get_used_count(token)
+            resp = jsonify(
+                {
+                    "success": True,
+                    "job_id": task.id,
+                    "used": used_after,
+                    "limit": FREE_LIMIT,
+                    "remaining": max(0, FREE_LIMIT - used_after),
+                }
+            )
+            resp.status_code = 202
+            if not request.cookies.get("hr_token"):
+                resp.set_cookie("hr_token", token, httponly=True, samesite="Lax")
+            return resp
+
+        results = rank_uploaded_resumes(job_desc, uploads)
         logger.info(f"Token {token}: used {used_after}/{FREE_LIMIT} resumes total")
 
         logger.info(f"Ranked {len(results)} resumes successfully")
@@ -395,16 +1102,40 @@ def rank_resumes():
         )
 
         # Ensure token cookie is set on this response as well
-        flask_resp = make_response(resp)
         if not request.cookies.get("hr_token"):
-            flask_resp.set_cookie("hr_token", token, httponly=True, samesite="Lax")
-        return flask_resp
+            resp.set_cookie("hr_token", token, httponly=True, samesite="Lax")
+        return resp
 
     except Exception as e:
         logger.error(f"Ranking error: {e}")
+        if reserved:
+            # Nothing was analyzed, give the quota back
+            increment_usage(token, -len(uploads))
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/rank/status/<job_id>")
+@limiter.limit("60/minute")  # frontend polls every 2s
+def rank_status(job_id):
+    """Poll a queued /rank job (only when background jobs are enabled)."""
+    if celery_app is None:
+        return jsonify({"success": False, "error": "Background jobs are disabled"}), 404
+
+    result = celery_app.AsyncResult(job_id)
+    if result.successful():
+        return jsonify(
+            {"success": True, "state": result.state, "results": result.result}
+        )
+    if result.failed():
+        logger.error(f"Job {job_id} failed: {result.result}")
+        return (
+            jsonify(
+                {"success": False, "state": result.state, "error": "Analysis failed"}
+            ),
+            500,
+        )
+    return jsonify({"success": True, "state": result.state}), 202
+
 # For Vercel, you do NOT need app.run(); Vercel imports `app` as the handler.
 if __name__ == "__main__":
-    # Local dev only
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    # Local dev only; use `gunicorn app:app` (see gunicorn.conf.py) elsewhere
+    app.run(debug=True, host="0.0.0.0", port=5000, threaded=True)
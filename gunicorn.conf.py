@@ -0,0 +1,12 @@
+# Production server for non-Vercel deploys:  gunicorn app:app
+# /rank spends almost all of its time waiting on Gemini, so threaded
+# workers keep many requests in flight per process.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = "gthread"
+# Usage counters, rate limits and the analysis cache are per-process unless
+# REDIS_URL is set, so only run several processes when they share Redis.
+workers = int(os.getenv("WEB_CONCURRENCY", "2" if os.getenv("REDIS_URL") else "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+timeout = 120  # a full batch of Gemini calls can take a while
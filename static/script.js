@@ -283,11 +283,12 @@ class ResumeRanker {
         body: formData,
       });
 
-      if (!response.ok) {
-        throw new Error(`Server error: ${response.status}`);
-      }
+      let data = await this.readJsonResponse(response);
 
-      const data = await response.json();
+      // Queued on a background worker: poll until the job finishes
+      if (data.success && data.job_id) {
+        data = await this.pollRankJob(data.job_id);
+      }
 
       if (data.success) {
         this.renderResults(data.results);
@@ -310,6 +311,37 @@ class ResumeRanker {
     }
   }
 
+  // Parse a JSON reply; on errors (402 quota, 429 rate limit, ...) surface
+  // the server's message instead of a bare status code
+  async readJsonResponse(response) {
+    let data = null;
+    try {
+      data = await response.json();
+    } catch (_) {
+      // non-JSON body (e.g. proxy error page)
+    }
+
+    if (!response.ok || !data) {
+      throw new Error((data && data.error) || `Server error: ${response.status}`);
+    }
+    return data;
+  }
+
+  async pollRankJob(jobId) {
+    // Unknown or lost jobs stay PENDING forever, so give up after ~5 minutes
+    const maxAttempts = 150;
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+      await new Promise((resolve) => setTimeout(resolve, 2000));
+
+      const response = await fetch(`/rank/status/${encodeURIComponent(jobId)}`);
+      const data = await this.readJsonResponse(response);
+      if (!data.success || data.results) {
+        return data;
+      }
+    }
+    throw new Error('Analysis is taking too long. Please try again later.');
+  }
+
   /* ===== RESULTS RENDERING ===== */
   renderResults(results) {
     results.sort((a, b) => b.overallScore - a.overallScore);